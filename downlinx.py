@@ -1,16 +1,22 @@
 #!/usr/bin/env python3
 
-import datetime
+import atexit
+import concurrent.futures
 from distutils.spawn import find_executable
+import functools
 import importlib.util
 import json
 import os
-import pathlib
 import re
 import shutil
+import struct
 import subprocess
 import sys
-from typing import List, NamedTuple, Optional
+import tempfile
+import time
+import urllib.error
+import urllib.request
+from typing import Dict, List, NamedTuple, Optional, Tuple
 
 
 def _is_legacy_imagemagick() -> Optional[bool]:
@@ -29,13 +35,52 @@ def _is_legacy_imagemagick() -> Optional[bool]:
 
 LEGACY_IMAGE_MAGICK = _is_legacy_imagemagick()
 
-def _has_whitespace(string: str) -> bool:
-    """Return True if a string has whitespace."""
-    return bool(re.search(r'\s', string))
+_MAGICK_PREFIX = ('magick',) if LEGACY_IMAGE_MAGICK is False else ()
+"""Argv prefix for ImageMagick commands: modern installs route every tool through
+the 'magick' binary, legacy installs invoke the tools directly."""
+
+_IDENTIFY_CMD = _MAGICK_PREFIX + ('identify',)
+"""Precomputed argv for the identify tool."""
+
+def _make_scratch_dir() -> Optional[str]:
+    """Create a per-run scratch directory on tmpfs for intermediate images and
+    ImageMagick temporary files, so they never touch persistent storage. It is
+    removed when the process exits. Returns None if tmpfs is unavailable, or if
+    disabled with DOWNLINX_TMPFS=0 in the environment."""
+    if os.environ.get('DOWNLINX_TMPFS') == '0':
+        return None
+    if not os.path.isdir('/dev/shm') or not os.access('/dev/shm', os.W_OK):
+        return None
+    scratch_dir = tempfile.mkdtemp(prefix='downlinx-', dir='/dev/shm')
+    atexit.register(shutil.rmtree, scratch_dir, ignore_errors=True)
+    return scratch_dir
+
+_SCRATCH_DIR = _make_scratch_dir()
+
+_MAGICK_ENV = {
+    **os.environ,
+    'MAGICK_THREAD_LIMIT': str(os.cpu_count() or 1),
+    'MAGICK_THROTTLE': '0',
+    'MAGICK_MEMORY_LIMIT': '4GiB',
+}
+if _SCRATCH_DIR is not None:
+    _MAGICK_ENV['MAGICK_TEMPORARY_PATH'] = _SCRATCH_DIR
+"""Environment for ImageMagick invocations. Short-lived converts often end up with a
+conservative thread policy, so explicitly let the resize/composite pixel loops use
+every core, and allow enough memory to process a full disk satellite image without
+spilling pixel cache to disk."""
+
+_MAGICK_LIMIT_ARGS = ('-limit', 'thread', str(os.cpu_count() or 1))
+"""Command line counterpart of MAGICK_THREAD_LIMIT, for installs whose policy.xml
+ignores the environment variable."""
+
+_has_whitespace = re.compile(r'\s').search
+"""Return a truthy value (a Match) if a string has whitespace, None otherwise.
+A precompiled bound method, so each call skips the re module's pattern-cache lookup."""
 
 def _assert_no_whitespace(string: str) -> None:
     """Assert that a string has no whitespace in it."""
-    assert not _has_whitespace(string)
+    assert _has_whitespace(string) is None
 
 def _quote_if_has_whitespace(string: str) -> str:
     """Single-quote a string if it has whitespace, escaping any single-quotes inside with a backslash."""
@@ -43,11 +88,23 @@ def _quote_if_has_whitespace(string: str) -> str:
         return string
     return "'{}'".format(string.replace("'", "\\'"))
 
+_VERBOSE = os.environ.get('DOWNLINX_QUIET') != '1'
+"""Whether to echo the commands downlinx runs. Set DOWNLINX_QUIET=1 to silence them."""
+
 def _check_call_with_echo(cmd: List[str], *args, **kwargs) -> None:
     """Like subprocess.check_call(), but it echos the command."""
-    print(*map(_quote_if_has_whitespace, cmd))
+    if _VERBOSE:
+        sys.stdout.write(' '.join(map(_quote_if_has_whitespace, cmd)) + '\n')
+        sys.stdout.flush()
     subprocess.check_call(cmd, *args, **kwargs)
 
+def _check_call_with_echo_and_input(cmd: List[str], input_bytes: bytes) -> None:
+    """Like _check_call_with_echo(), but feeds the given bytes to the command's stdin."""
+    if _VERBOSE:
+        sys.stdout.write(' '.join(map(_quote_if_has_whitespace, cmd)) + '\n')
+        sys.stdout.flush()
+    subprocess.run(cmd, input=input_bytes, check=True)
+
 def _replace_spaces(source_name: str) -> str:
     """Replace the spaces in a source name with underscores to
     produce something nice for filenames."""
@@ -62,14 +119,22 @@ def _ensure_directory_exists(filepath: str) -> None:
 
 def magick(*args) -> None:
     """Invoke ImageMagick with the specified arguments."""
-    cmdline = list(args)
-
-    if LEGACY_IMAGE_MAGICK is False:
-        cmdline.insert(0, 'magick')
-    elif args[0] != 'convert':
-        cmdline.insert(0, 'convert')
-
-    _check_call_with_echo(cmdline)
+    if LEGACY_IMAGE_MAGICK is not False and args[0] != 'convert':
+        cmdline = ['convert', *_MAGICK_LIMIT_ARGS, *args]
+    else:
+        cmdline = [*_MAGICK_PREFIX, args[0], *_MAGICK_LIMIT_ARGS, *args[1:]]
+    _check_call_with_echo(cmdline, env=_MAGICK_ENV)
+
+# Optional backend that renders the operation graph in-process with libvips instead
+# of forking ImageMagick. Select it with DOWNLINX_BACKEND=vips in the environment.
+if os.environ.get('DOWNLINX_BACKEND') == 'vips':
+    try:
+        import pyvips  # type: ignore
+    except ImportError:
+        pyvips = None  # type: ignore
+        print('DOWNLINX_BACKEND=vips was requested but pyvips is not installed; falling back to ImageMagick.')
+else:
+    pyvips = None  # type: ignore
 
 MAGICK_PNG_COLOR = ['-define', 'png:color-type=6']
 """This needs to always come before the output image name in any ImageMagick command
@@ -113,27 +178,121 @@ def aspect_ratio(size: Size) -> float:
     """Return the aspect ratio of the given Size."""
     return float(size.w) / size.h
 
+_COLOR_RGB = {
+    'black': (0, 0, 0),
+    'white': (255, 255, 255),
+}
+
+def _color_rgb(color: str) -> List[int]:
+    """Translate a color name or #rrggbb value into an RGB triple for the vips backend."""
+    if color in _COLOR_RGB:
+        return list(_COLOR_RGB[color])
+    match = re.fullmatch(r'#([0-9a-fA-F]{6})', color)
+    if match:
+        value = int(match.group(1), 16)
+        return [value >> 16 & 0xff, value >> 8 & 0xff, value & 0xff]
+    raise Exception(f'Color "{color}" is not supported by the vips backend; use an #rrggbb value')
+
 def centering_offset(image_size: Size, frame_size: Size, frame_offset: Pos = Pos(0, 0)) -> Pos:
     """Return the offset that will place the image in the center of the frame."""
     return add_pos(frame_offset, Pos(int(frame_size.w/2 - image_size.w/2), int(frame_size.h/2 - image_size.h/2)))
 
+def _read_size_png(filepath: str) -> Size:
+    """Read the dimensions of a PNG from its IHDR chunk, which always starts at a
+    fixed offset in the file."""
+    with open(filepath, 'rb') as f:
+        header = f.read(24)
+    assert header[:8] == b'\x89PNG\r\n\x1a\n', f'{filepath} is not a PNG'
+    width, height = struct.unpack('>II', header[16:24])
+    return Size(width, height)
+
+def _read_size_jpeg(filepath: str) -> Size:
+    """Read the dimensions of a JPEG by scanning its segments for a start-of-frame
+    marker, which records the frame height and width."""
+    with open(filepath, 'rb') as f:
+        assert f.read(2) == b'\xff\xd8', f'{filepath} is not a JPEG'
+        while True:
+            marker, length = struct.unpack('>2sH', f.read(4))
+            assert marker[0] == 0xff, f'{filepath} has a malformed JPEG segment'
+            # SOF0 through SOF3 cover baseline, extended, and progressive frames.
+            if b'\xc0' <= marker[1:] <= b'\xc3':
+                _, height, width = struct.unpack('>BHH', f.read(5))
+                return Size(width, height)
+            f.seek(length - 2, os.SEEK_CUR)
+
+_image_size_cache: Dict[Tuple[str, float, int], Size] = {}
+"""Cache of image sizes keyed by (filepath, mtime, file size), so that
+re-instantiating an Image for an unchanged file costs only a stat."""
+
+def _image_size(filepath: str) -> Size:
+    """Determine the dimensions of an image. PNG and JPEG headers are parsed directly
+    in Python; anything else falls back to ImageMagick's identify command."""
+    st = os.stat(filepath)
+    cache_key = (filepath, st.st_mtime, st.st_size)
+    if cache_key in _image_size_cache:
+        return _image_size_cache[cache_key]
+
+    extension = os.path.splitext(filepath)[1].lower()
+    if extension == '.png':
+        size = _read_size_png(filepath)
+    elif extension in ('.jpg', '.jpeg'):
+        size = _read_size_jpeg(filepath)
+    elif pyvips is not None:
+        vips_image = pyvips.Image.new_from_file(filepath)
+        size = Size(vips_image.width, vips_image.height)
+    else:
+        output = subprocess.check_output([*_IDENTIFY_CMD, '-ping', '-format', '%w %h', filepath], env=_MAGICK_ENV)
+        size = Size(*map(int, output.split(b' ')))
+
+    _image_size_cache[cache_key] = size
+    return size
+
 class Image(object):
     """Represents an image in the pipeline. Stores the filename and image size."""
 
     def __init__(self, filepath: str) -> None:
-        self.filepath = filepath
-        cmdline = ['identify', '-ping', '-format', '%w %h', filepath]
-        if LEGACY_IMAGE_MAGICK is False:
-            cmdline.insert(0, 'magick')
-        output = subprocess.check_output(cmdline)
-        self.size = Size(*map(int, output.split(b' ')))
+        self.filepath: Optional[str] = filepath
+        self.size = _image_size(filepath)
+
+class _PendingImage(Image):
+    """An Image whose pixels have not been computed yet. It records the operation
+    that will produce it (and references to its input Images), so that a whole chain
+    of operations can be rendered by a single ImageMagick invocation when the result
+    is finally written to disk by Pipeline.materialize()."""
+
+    def __init__(self, pipeline: 'Pipeline', size: Size, op: Tuple) -> None:
+        self.filepath = None
+        self.size = size
+        self.pipeline = pipeline
+        self.op = op
+
+    def _inputs(self) -> List[Image]:
+        """Return the input Images of the operation that produces this Image."""
+        return [arg for arg in self.op if isinstance(arg, Image)]
 
 class Pipeline(object):
     """Represents the state of a generic image processing pipeline,
-    and provides functions for processing images."""
+    and provides functions for processing images.
+
+    Processing functions don't actually run ImageMagick; they just record the
+    requested operation and return a _PendingImage (sizes are computed in Python, so
+    things like centering_offset() work immediately). When a result is finally
+    needed, materialize() renders the whole operation graph with a single
+    ImageMagick invocation, avoiding one process fork and one PNG encode/decode
+    round trip per operation."""
 
     def __init__(self, pipeline_dir: str) -> None:
         self.images_dir = os.path.join(pipeline_dir, 'images')
+        # Intermediate images go in a per-run scratch directory, on tmpfs when
+        # available, which is removed when the process exits. Downloads and final
+        # images stay in images_dir: the download cache must survive between runs,
+        # and desktop environments keep reading the background image after we exit.
+        if _SCRATCH_DIR is not None:
+            self.scratch_dir = tempfile.mkdtemp(dir=_SCRATCH_DIR)
+        else:
+            os.makedirs(self.images_dir, exist_ok=True)
+            self.scratch_dir = tempfile.mkdtemp(prefix='scratch-', dir=self.images_dir)
+            atexit.register(shutil.rmtree, self.scratch_dir, ignore_errors=True)
         self.generated_image_count = 0
 
     def _image_path(self, filename: str) -> str:
@@ -142,75 +301,262 @@ class Pipeline(object):
 
     def _new(self, image_type: str) -> str:
         """Generate a path for a new image of a given type that you can write to,
-        ensure the directory for it exists, and delete the image if it exists."""
+        and ensure the directory for it exists. A leftover image from a previous run
+        is simply overwritten by whatever renders to the path. Intermediate
+        (MPC/.v) images go in the scratch directory, which is fresh each run."""
         filename = f'generated{self.generated_image_count}.{image_type}'
-        filepath = self._image_path(filename)
+        if image_type in ('mpc', 'v'):
+            filepath = os.path.join(self.scratch_dir, filename)
+        else:
+            filepath = self._image_path(filename)
         _assert_no_whitespace(filepath)
         _ensure_directory_exists(filepath)
         self.generated_image_count += 1
-        if os.path.isfile(filepath):
-            os.remove(filepath)
         return filepath
 
     def crop(self, image: Image, offset: Pos, size: Size) -> Image:
-        """Crop an Image. Return the new Image."""
-        cropped = self._new('png')
-        magick('convert', image.filepath, '-crop', f'{size.w}x{size.h}+{offset.x}+{offset.y}', *MAGICK_PNG_COLOR, cropped)
-        return Image(cropped)
+        """Crop an Image. Return the new (pending) Image."""
+        cropped_size = Size(min(size.w, image.size.w - offset.x), min(size.h, image.size.h - offset.y))
+        return _PendingImage(self, cropped_size, ('crop', image, offset, size))
 
     def blank(self, color: str, size: Size) -> Image:
-        """Create a blank Image with the specified color and dimensions. Return the new Image."""
-        new = self._new('png')
-        magick('convert', '-size', f'{size.w}x{size.h}', f'canvas:{color}', *MAGICK_PNG_COLOR, new)
-        return Image(new)
+        """Create a blank Image with the specified color and dimensions. Return the new (pending) Image."""
+        return _PendingImage(self, size, ('blank', color, size))
 
     def place(self, new: Image, offset: Pos, base: Image) -> Image:
-        """Place a new Image on top of a base Image. Return the new Image."""
-        combined = self._new('png')
-        magick('convert', base.filepath, new.filepath, '-geometry', f'+{offset.x}+{offset.y}', '-composite', *MAGICK_PNG_COLOR, combined)
-        return Image(combined)
+        """Place a new Image on top of a base Image. Return the new (pending) Image."""
+        return _PendingImage(self, base.size, ('place', new, offset, base))
 
     def resize(self, image: Image, size: Size) -> Image:
-        """Resize an Image. Return the new Image."""
-        resized = self._new('png')
-        magick('convert', image.filepath, '-resize', f'{size.w}x{size.h}', *MAGICK_PNG_COLOR, resized)
-        return Image(resized)
+        """Resize an Image to exactly the given size, stretching it if the aspect
+        ratio doesn't match (use the scale_to_* helpers to compute a size that
+        preserves it). The exact dimensions are forced so that the sizes computed in
+        Python always agree with what gets rendered, where a bare ImageMagick
+        -resize may round differently while preserving aspect ratio.
+        Return the new (pending) Image."""
+        return _PendingImage(self, size, ('resize', image, size))
+
+    def draw_rects(self, image: Image, rects: List[Tuple[str, int, int, int, int]]) -> Image:
+        """Paint filled rectangles over an Image, given as (color, x0, y0, x1, y1)
+        tuples with inclusive corners. Cheaper than compositing blank Images on top.
+        Return the new (pending) Image."""
+        return _PendingImage(self, image.size, ('draw', image, rects))
+
+    def crop_and_draw_rects(self, image: Image, crop_offset: Pos, crop_size: Size,
+                            rects: List[Tuple[str, int, int, int, int]]) -> Image:
+        """Crop an Image, then paint filled rectangles over the cropped result.
+        Rectangle coordinates are relative to the crop. Return the new (pending) Image."""
+        return self.draw_rects(self.crop(image, crop_offset, crop_size), rects)
+
+    def snapshot(self, image: Image) -> Image:
+        """Render a pending Image to an intermediate file, so that later operations
+        (possibly feeding several different outputs) start from the rendered pixels
+        instead of re-running the whole operation graph. The file is written in a raw
+        uncompressed format (ImageMagick's MPC, or libvips's native .v under the vips
+        backend), which skips PNG compression entirely and is memory-mapped on read."""
+        return self.materialize(image, image_type='v' if pyvips is not None else 'mpc')
 
     def to_jpg(self, image: Image) -> Image:
         """Convert an Image to jpg. Return the new Image."""
+        if isinstance(image, _PendingImage):
+            return self.materialize(image, image_type='jpg')
         jpg = self._new('jpg')
         magick('convert', image.filepath, jpg)
         return Image(jpg)
 
+    def _count_references(self, image: Image, counts: Dict[int, int]) -> None:
+        """Count how many times each _PendingImage in the operation graph is referenced."""
+        if not isinstance(image, _PendingImage):
+            return
+        counts[id(image)] = counts.get(id(image), 0) + 1
+        if counts[id(image)] > 1:
+            return
+        for inp in image._inputs():
+            self._count_references(inp, counts)
+
+    def _op_args(self, image: Image, mpr_labels: Dict[int, str]) -> List[str]:
+        """Return the ImageMagick arguments that produce the given Image,
+        for splicing into a larger command line."""
+        if isinstance(image, _PendingImage) and id(image) in mpr_labels:
+            return [f'mpr:{mpr_labels[id(image)]}']
+        if not isinstance(image, _PendingImage):
+            assert image.filepath is not None
+            return [image.filepath]
+
+        kind = image.op[0]
+        if kind == 'blank':
+            _, color, size = image.op
+            # +size resets the size setting so it can't act as a decode hint for later reads.
+            return ['-size', f'{size.w}x{size.h}', f'canvas:{color}', '+size']
+        if kind == 'crop':
+            _, source, offset, size = image.op
+            return self._op_args(source, mpr_labels) + ['-crop', f'{size.w}x{size.h}+{offset.x}+{offset.y}', '+repage']
+        if kind == 'resize':
+            _, source, size = image.op
+            return self._op_args(source, mpr_labels) + ['-resize', f'{size.w}x{size.h}!']
+        if kind == 'place':
+            _, new, offset, base = image.op
+            return (self._op_args(base, mpr_labels)
+                    + ['('] + self._op_args(new, mpr_labels) + [')']
+                    + ['-geometry', f'+{offset.x}+{offset.y}', '-composite'])
+        if kind == 'draw':
+            _, source, rects = image.op
+            args = self._op_args(source, mpr_labels)
+            for color, x0, y0, x1, y1 in rects:
+                args += ['-fill', color, '-draw', f'rectangle {x0},{y0} {x1},{y1}']
+            return args
+        raise Exception(f'Unknown pipeline operation "{kind}"')
+
+    def _shared_images(self, image: Image, counts: Dict[int, int], shared: List[Image], seen: Dict[int, bool]) -> None:
+        """Collect the _PendingImages referenced more than once, in dependency order
+        (post-order), so each can be rendered once and reused via mpr:."""
+        if not isinstance(image, _PendingImage) or id(image) in seen:
+            return
+        seen[id(image)] = True
+        for inp in image._inputs():
+            self._shared_images(inp, counts, shared, seen)
+        if counts[id(image)] > 1:
+            shared.append(image)
+
+    def _vips_image(self, image: Image, rendered: Dict[int, object]):
+        """Recursively build the pyvips operation graph for an Image."""
+        if not isinstance(image, _PendingImage):
+            return pyvips.Image.new_from_file(image.filepath)
+        if id(image) in rendered:
+            return rendered[id(image)]
+
+        kind = image.op[0]
+        if kind == 'blank':
+            _, color, size = image.op
+            result = pyvips.Image.black(size.w, size.h, bands=3).new_from_image(_color_rgb(color)).copy(interpretation='srgb')
+        elif kind == 'crop':
+            _, source, offset, size = image.op
+            result = self._vips_image(source, rendered).crop(offset.x, offset.y, image.size.w, image.size.h)
+        elif kind == 'resize':
+            _, source, size = image.op
+            result = self._vips_image(source, rendered).resize(size.w / source.size.w, vscale=size.h / source.size.h)
+        elif kind == 'place':
+            _, new, offset, base = image.op
+            result = self._vips_image(base, rendered).composite2(self._vips_image(new, rendered), 'over', x=offset.x, y=offset.y)
+        elif kind == 'draw':
+            _, source, rects = image.op
+            result = self._vips_image(source, rendered)
+            for color, x0, y0, x1, y1 in rects:
+                result = result.draw_rect(_color_rgb(color), x0, y0, x1 - x0 + 1, y1 - y0 + 1, fill=True)
+        else:
+            raise Exception(f'Unknown pipeline operation "{kind}"')
+        rendered[id(image)] = result
+        return result
+
+    def materialize(self, image: Image, out_path: Optional[str] = None, image_type: str = 'png') -> Image:
+        """Render a pending Image to a real file and return the resulting concrete
+        Image. Concrete Images are returned as-is. With the default backend the whole
+        operation graph becomes a single ImageMagick invocation; with the vips backend
+        it is rendered in-process by libvips, with no subprocess at all."""
+        if not isinstance(image, _PendingImage):
+            return image
+        if out_path is None:
+            out_path = self._new(image_type)
+
+        if pyvips is not None and out_path.endswith(('.png', '.jpg', '.v')):
+            if _VERBOSE:
+                print(f'pyvips render -> {out_path}')
+            result = self._vips_image(image, {})
+            if out_path.endswith('.png') and not result.hasalpha():
+                # The vips counterpart of MAGICK_PNG_COLOR: write PNGs as RGBA
+                # (color-type 6) so desktop backgrounds don't get distorted colors.
+                result = result.addalpha()
+            result.write_to_file(out_path)
+            return Image(out_path)
+
+        counts: Dict[int, int] = {}
+        self._count_references(image, counts)
+        shared: List[Image] = []
+        self._shared_images(image, counts, shared, {})
+
+        mpr_labels: Dict[int, str] = {}
+        args: List[str] = []
+        # Render subresults that are referenced more than once into ImageMagick's
+        # in-memory register (mpr:) first, so they are computed only once.
+        for n, sub in enumerate(shared):
+            args += ['('] + self._op_args(sub, mpr_labels) + ['-write', f'mpr:sub{n}', ')', '+delete']
+            mpr_labels[id(sub)] = f'sub{n}'
+        args += self._op_args(image, mpr_labels)
+
+        if out_path.endswith('.png'):
+            args += MAGICK_PNG_COLOR
+        magick('convert', *args, out_path)
+        return Image(out_path)
+
+    def finalize(self, image: Image, dest_path: str) -> Image:
+        """Render an Image (if it is still pending) straight to dest_path, or put an
+        already-rendered file there. Useful when the result should live somewhere
+        other than the images directory. Return the Image at its final location."""
+        _ensure_directory_exists(dest_path)
+        if isinstance(image, _PendingImage):
+            return self.materialize(image, out_path=dest_path)
+        assert image.filepath is not None
+        if os.path.dirname(os.path.abspath(image.filepath)) == os.path.abspath(self.scratch_dir):
+            shutil.move(image.filepath, dest_path)
+        else:
+            # Only scratch intermediates are safe to relocate. Anything else might be
+            # a file we didn't create, like the download cache, which later runs'
+            # freshness checks depend on finding in place.
+            shutil.copyfile(image.filepath, dest_path)
+        return Image(dest_path)
+
+def _rendered_filepath(image: Image) -> str:
+    """Render an Image to a real file if it is still pending, and return the file's
+    path, so that external programs can read it."""
+    if isinstance(image, _PendingImage):
+        image = image.pipeline.materialize(image)
+    assert image.filepath is not None
+    return image.filepath
+
+@functools.lru_cache(maxsize=None)
+def _load_sources(sources_path: str, mtime: float) -> list:
+    """Load and parse a sources.json file. Cached per (path, mtime), so several
+    pipelines in one process parse the file only once while edits are still
+    picked up."""
+    with open(sources_path) as f:
+        return json.load(f)['sources']
+
+def _find_sources(pipeline_dir: str) -> list:
+    """Return the parsed sources for a pipeline. Searches for sources.json first in
+    the pipeline directory, or falls back to the version shipped with downlinx
+    otherwise."""
+    script_dir = os.path.dirname(os.path.realpath(__file__))
+    sources_path = os.path.join(pipeline_dir, 'sources.json')
+    if not os.path.isfile(sources_path):
+        sources_path = os.path.join(script_dir, 'sources.json')
+    return _load_sources(sources_path, os.path.getmtime(sources_path))
+
 class Downlinx(Pipeline):
     """Subclass of Pipeline with functions specifically useful for processing satellite images."""
     def __init__(self, pipeline_dir: str) -> None:
         super().__init__(pipeline_dir)
 
-        # Search for sources.json first in the config directory, or fall back to the version shipped with
-        # downlinx otherwise.
-        script_dir = os.path.dirname(os.path.realpath(__file__))
-        sources_path = os.path.join(pipeline_dir, 'sources.json')
-        if not os.path.isfile(sources_path):
-            sources_path = os.path.join(script_dir, 'sources.json')
-
-        with open(sources_path) as f:
-            self.sources = json.load(f)['sources']
-        self._assert_unique_names()
+        self.sources = _find_sources(pipeline_dir)
+        self._index_sources()
         self._assert_all_formats_expected()
 
-    def _assert_unique_names(self) -> None:
-        """Assert that all image source names are unique, and remain so under _replace_spaces()."""
-        unique_names = set()
+        self._clean_cache: Dict[Tuple[str, float], Image] = {}
+        """Cleaned up full disk images, keyed by (source name, downloaded file mtime),
+        so that asking for the same cleaned image twice does no extra work."""
+
+    def _index_sources(self) -> None:
+        """Index the image sources by name for O(1) lookup, asserting along the way that
+        all names are unique, and remain so under _replace_spaces()."""
+        self._sources_by_name: Dict[str, dict] = {}
         unique_names_no_spaces = set()
         for s in self.sources:
             name = s['name']
             name_no_spaces = _replace_spaces(name)
-            if name in unique_names:
+            if name in self._sources_by_name:
                 raise Exception(f'Name "{name}" is not unique in the sources list')
             if name_no_spaces in unique_names_no_spaces:
                 raise Exception(f'Spaceless name "{name_no_spaces}" is not unique in the sources list')
-            unique_names.add(name)
+            self._sources_by_name[name] = s
             unique_names_no_spaces.add(name_no_spaces)
 
     def _assert_all_formats_expected(self) -> None:
@@ -220,41 +566,112 @@ class Downlinx(Pipeline):
                 assert u.endswith('.jpg')
 
     def _source(self, source_name: str):
-        """Retrieve an image source by name."""
-        for s in self.sources:
-            if s['name'] == source_name:
-                return s
+        """Retrieve an image source by name. Raises KeyError if there is no such source."""
+        return self._sources_by_name[source_name]
 
-    def get(self, source_name: str, size: str) -> Image:
-        """Get an Image from one of the sources, or if it's already present and recent enough, don't."""
+    def _download_path(self, source_name: str, size: str) -> str:
+        """Return the path where a downloaded image is cached, ensuring the directory for it exists."""
         filename = '{}_{}.jpg'.format(_replace_spaces(source_name), size)
         filepath = self._image_path(filename)
         _assert_no_whitespace(filepath)
         _ensure_directory_exists(filepath)
+        return filepath
 
-        source = self._source(source_name)
+    def _is_fresh(self, filepath: str, source) -> bool:
+        """Return True if we already have a sufficiently recent copy of an image, so it
+        need not be downloaded again."""
+        if not os.path.isfile(filepath):
+            return False
+        age = int(time.time() - os.stat(filepath).st_mtime)
+        if age < source['interval']:
+            if _VERBOSE:
+                print(f"Skipping download of {os.path.basename(filepath)}, it's only {age} seconds old.")
+            return True
+        return False
+
+    def _fetch(self, filepath: str, url: str) -> None:
+        """Download url to filepath. Sends a conditional GET using the validators the
+        server gave us last time (stored next to the file), so an unchanged image
+        answers with a bodyless 304 instead of a multi-megabyte transfer. Falls back
+        to curl if the download fails for reasons other than an HTTP error."""
+        headers_path = filepath + '.etag.json'
+        request = urllib.request.Request(url)
+        if os.path.isfile(filepath) and os.path.isfile(headers_path):
+            with open(headers_path) as f:
+                validators = json.load(f)
+            if 'ETag' in validators:
+                request.add_header('If-None-Match', validators['ETag'])
+            if 'Last-Modified' in validators:
+                request.add_header('If-Modified-Since', validators['Last-Modified'])
+
+        # Download to a temporary file and rename into place once complete, so a
+        # failed transfer can never leave a truncated image in the cache.
+        tmp_path = filepath + '.tmp'
+        if _VERBOSE:
+            print(f'GET {url}')
+        try:
+            try:
+                with urllib.request.urlopen(request) as response:
+                    with open(tmp_path, 'wb') as f:
+                        shutil.copyfileobj(response, f, 64 * 1024)
+                    validators = {name: response.headers[name]
+                                  for name in ('ETag', 'Last-Modified') if response.headers.get(name)}
+                    with open(headers_path, 'w') as f:
+                        json.dump(validators, f)
+            except urllib.error.HTTPError as e:
+                if e.code != 304:
+                    raise
+                # Unchanged on the server; refresh the cached copy's mtime so the
+                # freshness check doesn't ask again until the source interval passes.
+                if _VERBOSE:
+                    print(f'{os.path.basename(filepath)} is unchanged on the server.')
+                os.utime(filepath, None)
+                return
+            except urllib.error.URLError:
+                _check_call_with_echo(['curl', '--fail', '--compressed', '--retry', '3', '-o', tmp_path, url])
+            os.replace(tmp_path, filepath)
+        except BaseException:
+            if os.path.isfile(tmp_path):
+                os.remove(tmp_path)
+            raise
 
-        # Don't download again if we already have a sufficiently recent version.
-        if os.path.isfile(filepath):
-            modification_time = datetime.datetime.fromtimestamp(pathlib.Path(filepath).stat().st_mtime)
-            now = datetime.datetime.now()
-            age = (now - modification_time).seconds
-            if age < source['interval']:
-                print(f"Skipping download of {filename}, it's only {age} seconds old.")
-                return Image(filepath)
-
-        # Download the image.
-        url = source['url'][size]
-        _check_call_with_echo(['curl', '-o', filepath, url])
+    def get(self, source_name: str, size: str) -> Image:
+        """Get an Image from one of the sources, or if it's already present and recent enough, don't."""
+        filepath = self._download_path(source_name, size)
+        source = self._source(source_name)
+        if not self._is_fresh(filepath, source):
+            self._fetch(filepath, source['url'][size])
         return Image(filepath)
 
+    def get_many(self, specs: List[Tuple[str, str]]) -> List[Image]:
+        """Get Images from several sources at once, given a list of (source_name, size)
+        pairs. All the stale ones are downloaded in parallel, so the total wait is the
+        slowest transfer rather than the sum of them. Calling this at the top of a
+        pipeline also makes later get() calls for the same images free."""
+        stale = []
+        for source_name, size in specs:
+            filepath = self._download_path(source_name, size)
+            source = self._source(source_name)
+            if not self._is_fresh(filepath, source):
+                stale.append((filepath, source['url'][size]))
+        if stale:
+            with concurrent.futures.ThreadPoolExecutor(max_workers=8) as executor:
+                futures = [executor.submit(self._fetch, filepath, url) for filepath, url in stale]
+                for future in futures:
+                    future.result()
+        return [Image(self._download_path(source_name, size)) for source_name, size in specs]
+
     def _clean_goes_large(self, source_name: str) -> Image:
         """Return a cleaned up large full disk GOES image from the given source."""
         full_disk = self.get(source_name, 'large')
-        full_disk_minus_info_bar = self.crop(full_disk, Pos(0, 0), Size(full_disk.size.w, full_disk.size.h - 47))
-        logo_hider = self.blank('black', Size(400, 400))
-        full_disk_clean = self.place(logo_hider, Pos(0, full_disk_minus_info_bar.size.h - logo_hider.size.h), full_disk_minus_info_bar)
-        return full_disk_clean
+        assert full_disk.filepath is not None
+        cache_key = (source_name, os.path.getmtime(full_disk.filepath))
+        if cache_key not in self._clean_cache:
+            cropped_height = full_disk.size.h - 47  # Remove the info bar along the bottom.
+            self._clean_cache[cache_key] = self.crop_and_draw_rects(
+                full_disk, Pos(0, 0), Size(full_disk.size.w, cropped_height),
+                [('black', 0, cropped_height - 400, 399, cropped_height - 1)])  # Hide the logos.
+        return self._clean_cache[cache_key]
 
     def clean_goes_east_large(self) -> Image:
         """Return a cleaned up large full disk GOES-East image."""
@@ -267,27 +684,42 @@ class Downlinx(Pipeline):
     def clean_himawari8_large(self) -> Image:
         """Return a cleaned up large full disk Himawari-8 image."""
         full_disk = self.get('Himawari-8 Full Disk', 'large')
-        logo_hider = self.blank('black', Size(1000, 450))
-        full_disk_clean = self.place(logo_hider, Pos(0, full_disk.size.h - logo_hider.size.h), full_disk)
-        return full_disk_clean
+        assert full_disk.filepath is not None
+        cache_key = ('Himawari-8 Full Disk', os.path.getmtime(full_disk.filepath))
+        if cache_key not in self._clean_cache:
+            self._clean_cache[cache_key] = self.draw_rects(
+                full_disk,
+                [('black', 0, full_disk.size.h - 450, 999, full_disk.size.h - 1)])  # Hide the labels.
+        return self._clean_cache[cache_key]
 
 def set_background_wm_only(image: Image) -> None:
     """Put an Image up on the desktop background. It should be a JPG because PNGs can have colors distorted.
     This function is for people using a window manager (like XMonad or Openbox) but no desktop environment."""
-    _check_call_with_echo(['xloadimage', '-onroot', image.filepath])
+    _check_call_with_echo(['xloadimage', '-onroot', _rendered_filepath(image)])
 
 # NOTE: set_background_gnome2() has not been tested. It might not work! Consider submitting a PR if you figure it out.
 def set_background_gnome2(image: Image) -> None:
     """Put an Image up on the desktop background.
     This function is for people using GNOME 2."""
-    _check_call_with_echo(['gconftool-2', '--type=string', '--set', '/desktop/gnome/background/picture_filename', os.path.abspath(image.filepath)])
+    _check_call_with_echo(['gconftool-2', '--type=string', '--set', '/desktop/gnome/background/picture_filename', os.path.abspath(_rendered_filepath(image))])
 
 # NOTE: set_background_gnome3() has not been tested. It might not work! Consider submitting a PR if you figure it out.
 def set_background_gnome3(image: Image) -> None:
     """Put an Image up on the desktop background.
     This function is for people using GNOME 3 or Unity."""
-    _check_call_with_echo(['gsettings', 'set', 'org.gnome.desktop.background', 'picture-uri', 'file://' + os.path.abspath(image.filepath)])
-    _check_call_with_echo(['gsettings', 'set', 'org.gnome.desktop.background', 'picture-options', 'spanned'])
+    uri = 'file://' + os.path.abspath(_rendered_filepath(image))
+    if find_executable('dconf'):
+        # One dconf invocation sets both keys: one process spawn and one D-Bus round trip instead of two.
+        # The uri is embedded in a single-quoted GVariant string literal, so escape
+        # any backslashes and quotes the path contains.
+        quoted_uri = uri.replace('\\', '\\\\').replace("'", "\\'")
+        keyfile = ('[org/gnome/desktop/background]\n'
+                   f"picture-uri='{quoted_uri}'\n"
+                   "picture-options='spanned'\n")
+        _check_call_with_echo_and_input(['dconf', 'load', '/'], keyfile.encode())
+    else:
+        _check_call_with_echo(['gsettings', 'set', 'org.gnome.desktop.background', 'picture-uri', uri])
+        _check_call_with_echo(['gsettings', 'set', 'org.gnome.desktop.background', 'picture-options', 'spanned'])
 
 def set_background_xfce(monitor: str, image: Image) -> None:
     """Put an Image up on the desktop background on the specified monitor and workspace (for example, 'screen0/monitorHDMI-0/workspace0').
@@ -295,11 +727,11 @@ def set_background_xfce(monitor: str, image: Image) -> None:
     Unlike the other background setting functions, this one work on only one monitor at a time,
     so you will need to compose multiple images (or produce multiple crops).
     This function is for people using Xfce."""
-    _check_call_with_echo(['xfconf-query', '--channel', 'xfce4-desktop', '--property', '/backdrop/' + monitor + '/last-image', '--set', os.path.abspath(image.filepath)])
+    _check_call_with_echo(['xfconf-query', '--channel', 'xfce4-desktop', '--property', '/backdrop/' + monitor + '/last-image', '--set', os.path.abspath(_rendered_filepath(image))])
 
 def eog(image: Image) -> None:
     """Open an Image in the EOG image viewer. Useful for debugging. This call will block until EOG exits."""
-    _check_call_with_echo(['eog', image.filepath])
+    _check_call_with_echo(['eog', _rendered_filepath(image)])
 
 def main():
     """Run run.py in the directory specified on the command line."""
@@ -23,6 +23,10 @@ tmahlmann1_cropped = pipeline.crop(tmahlmann1_scaled, Pos(800, 0), monitor1_size
 tmahlmann2_scaled = pipeline.resize(tmahlmann2, scale_to_height(tmahlmann2.size, monitor3_size.h+20))
 tmahlmann2_cropped = pipeline.crop(tmahlmann2_scaled, Pos(0, 0), monitor3_size)
 
+# Download both satellite images in parallel up front.
+pipeline.get_many([('Himawari-8 Full Disk', 'large'),
+                   ('GOES-East Full Disk', 'large')])
+
 himawari8 = pipeline.clean_himawari8_large()
 goes_east = pipeline.clean_goes_east_large()
 earth_box_size = Size(int(monitor2_size.w/2), monitor2_size.h)
@@ -14,6 +14,11 @@ monitor2_size = Size(2560, 1440)
 monitor3_pos = Pos(3760, 240)
 monitor3_size = Size(1280, 1024)
 
+# Download all three satellite images in parallel up front.
+pipeline.get_many([('Himawari-8 Full Disk', 'large'),
+                   ('GOES-West Full Disk', 'large'),
+                   ('GOES-East Full Disk', 'large')])
+
 himawari8 = pipeline.clean_himawari8_large()
 goes_west = pipeline.clean_goes_west_large()
 goes_east = pipeline.clean_goes_east_large()